@@ -1,14 +1,19 @@
+import functools
 import pathlib
 import subprocess
+import weakref
 
 import numpy as np
 import pandas as pd
 import pyBigWig
 import xarray as xr
-from numba import njit
+from numba import njit, prange
 
 from ALLCools.utilities import parse_mc_pattern
 
+# use the parallel numba kernel in _regions_to_pos only for many regions, to avoid thread launch overhead
+_PARALLEL_MIN_REGIONS = 1024
+
 
 def _mvalue(mc, cov, alpha=0.1):
     m = np.log2((mc + alpha) / (cov - mc + alpha))
@@ -20,27 +25,83 @@ def _frac(mc, cov, alpha=0.001):
     return frac
 
 
-@njit
+@njit(parallel=True, cache=True)
+def _fill_regions_pos(starts, offsets, lengths, pos_sel):
+    """Fill positions of each region into pos_sel, regions write disjoint slices in parallel."""
+    for r in prange(starts.size):
+        start = starts[r]
+        offset = offsets[r]
+        for k in range(lengths[r]):
+            pos_sel[offset + k] = start + k
+
+
 def _regions_to_pos(regions: np.ndarray) -> np.ndarray:
     """Convert regions to positions."""
-    delta = regions[:, 1] - regions[:, 0]
-    pos_sel = np.zeros(delta.sum(), dtype=np.uint32)
-    cur_pos = 0
-    for start, end in regions:
-        length = end - start
-        pos_sel[cur_pos : cur_pos + length] = np.arange(start, end, dtype=np.uint32)
-        cur_pos += length
+    regions = np.asarray(regions)
+    lengths = (regions[:, 1] - regions[:, 0]).astype(np.uint32)
+    total = int(lengths.sum())
+    # output offset of each region
+    offsets = np.cumsum(lengths, dtype=np.uint32) - lengths
+    starts = regions[:, 0].astype(np.uint32)
+
+    if starts.size >= _PARALLEL_MIN_REGIONS:
+        pos_sel = np.empty(total, dtype=np.uint32)
+        _fill_regions_pos(starts, offsets, lengths, pos_sel)
+        return pos_sel
+
+    # region start minus the output offset of the region, repeated for every base it covers;
+    # adding the output index gives the position, uint32 wraparound cancels out in the sum
+    pos_sel = np.repeat(starts - offsets, lengths)
+    pos_sel += np.arange(total, dtype=np.uint32)
     return pos_sel
 
 
 def _chunk_pos_to_bed_df(chrom, chunk_pos):
     """Convert chunk positions to bed dataframe."""
-    records = []
-    for i in range(len(chunk_pos) - 1):
-        start = chunk_pos[i]
-        end = chunk_pos[i + 1]
-        records.append([chrom, start, end])
-    return pd.DataFrame(records, columns=["chrom", "start", "end"])
+    chunk_pos = np.asarray(chunk_pos)
+    return pd.DataFrame({"chrom": chrom, "start": chunk_pos[:-1], "end": chunk_pos[1:]})
+
+
+@functools.lru_cache(maxsize=100)
+def _parse_mc_pattern_array(mc_pattern):
+    """Parse mC context pattern into a sorted array, cached for repeated mc_type selection."""
+    return np.array(sorted(parse_mc_pattern(mc_pattern)))
+
+
+def _sum_by_bins(data, pos_values, bins, labels):
+    """
+    Sum data along the pos dim into bins.
+
+    Bins include the start position but exclude the end position, the same as BED format.
+    Both pos_values and bins must be sorted; positions outside the bins are ignored.
+    The reduction is lazy and streams pos chunks if data is backed by dask.
+    """
+    bins = np.asarray(bins)
+    if np.any(np.diff(bins) < 0):
+        raise ValueError("bins must increase monotonically, make sure the regions are sorted.")
+
+    # index range of the positions falling in each bin
+    bin_starts = np.searchsorted(pos_values, bins[:-1], side="left")
+    bin_ends = np.searchsorted(pos_values, bins[1:], side="left")
+
+    # the sum of each bin is the difference of the cumulative sum at bin end and bin start;
+    # cumsum is computed chunk by chunk in dask, so the pos dim is never merged into a single chunk.
+    # use a wide accumulator to prevent overflow of small integer count dtypes
+    acc_dtype = np.promote_types(data.dtype, np.int64)
+    data = data.drop_vars("pos", errors="ignore").astype(acc_dtype)
+    # prepend 0, so csum[i] is the sum of the first i positions; also valid when no position is selected
+    csum = data.cumsum(dim="pos").pad(pos=(1, 0), constant_values=0)
+    region_da = csum.isel(pos=bin_ends) - csum.isel(pos=bin_starts)
+
+    region_da = region_da.rename({"pos": "pos_bins"})
+    # labels can be a named pd.Index, which xarray would treat as a coord on a dim with that name
+    region_da.coords["pos_bins"] = ("pos_bins", np.asarray(labels))
+    return region_da
+
+
+# in-memory codebook cache of BaseDSChrom, id(ds) -> (weakref of ds, codebook variable, Codebook);
+# xr.Dataset is not hashable, so it can not be the key of a WeakKeyDictionary
+_CODEBOOK_CACHE = {}
 
 
 class Codebook(xr.DataArray):
@@ -82,14 +143,15 @@ class Codebook(xr.DataArray):
         """Get the boolean array of cytosines matching the pattern."""
         mc_pattern = self._validate_mc_pattern(mc_pattern)
 
-        if mc_pattern is None:
-            # get all mc types
-            judge = np.ones_like(self.mc_type, dtype=bool)
-        else:
-            # get mc types matching the pattern
-            judge = self.mc_type.isin(parse_mc_pattern(mc_pattern))
+        # get mc types matching the pattern
+        judge = np.isin(self.mc_type.values, _parse_mc_pattern_array(mc_pattern))
         # value can be -1, 0, 1, only 0 is False, -1 and 1 are True
-        _bool = self.sel(mc_type=judge).sum(dim="mc_type").values.astype(bool)
+        # reduce before loading, so only the selected mc types are streamed chunk by chunk;
+        # no need to subset if all mc types are selected
+        if judge.all():
+            _bool = self.any(dim="mc_type").values
+        else:
+            _bool = self.isel(mc_type=judge).any(dim="mc_type").values
         return _bool
 
     def get_mc_pos(self, mc_pattern, offset=None):
@@ -97,7 +159,10 @@ class Codebook(xr.DataArray):
         mc_pattern = self._validate_mc_pattern(mc_pattern)
 
         _bool = self.get_mc_pos_bool(mc_pattern)
+        return self._bool_to_pos(_bool, offset=offset)
 
+    def _bool_to_pos(self, _bool, offset=None):
+        """Get the positions of a boolean array returned by get_mc_pos_bool."""
         _pos = self.get_index("pos")[_bool].copy()
         if offset is not None:
             _pos += offset
@@ -182,16 +247,18 @@ class BaseDSChrom(xr.Dataset):
         Parameters
         ----------
         regions :
-            The regions to select. Iterable of (start, end) tuples.
+            The regions to select. Iterable of (start, end) tuples, (N, 2) array
+            or dataframe with start and end columns.
             Coordinates are 0-based and half-open, like the BED format.
 
         Returns
         -------
         BaseDSChrom
         """
-        regions = np.array(regions).astype("uint32")
-
-        assert regions.shape[1] == 2, "Regions can not be converted to (N, 2) array."
+        # no copy if regions is already a contiguous uint32 array
+        regions = np.ascontiguousarray(regions, dtype=np.uint32)
+        if regions.ndim != 2 or regions.shape[1] != 2:
+            raise ValueError(f"Regions can not be converted to (N, 2) array, got shape {regions.shape}.")
 
         pos_sel = _regions_to_pos(regions)
         obj = self.fetch_positions(pos_sel)
@@ -206,11 +273,33 @@ class BaseDSChrom(xr.Dataset):
         if positions.size == 0:
             obj = self.isel(pos=[])
         else:
-            positions = np.sort(positions).astype("uint32")
+            # callers usually pass a sorted and unique pd.Index, skip sorting in that case
+            presorted = isinstance(positions, pd.Index) and positions.is_monotonic_increasing and positions.is_unique
+            positions = np.asarray(positions, dtype=np.uint32)
+            if not presorted and positions.size > 1 and not np.all(positions[1:] > positions[:-1]):
+                # sort and remove duplicates in one pass
+                positions = np.unique(positions)
 
             # always apply offset to positions
             # if continuous is False, offset will be 0, so no effect
-            obj = self.sel(pos=positions - self.offset)
+            pos_sel = positions - self.offset
+            if "pos" in self.indexes:
+                # discontinuous, pos coords are sorted genome positions, translate to integer locations
+                pos_index = self.pos_values
+                int_idx = np.searchsorted(pos_index, pos_sel)
+                if int_idx[-1] >= pos_index.size or not np.array_equal(pos_index[int_idx], pos_sel):
+                    raise KeyError("Some positions are not included in the BaseDSChrom.")
+            else:
+                # continuous without pos coords, positions are integer locations already
+                int_idx = pos_sel
+                if int_idx[-1] >= self.sizes["pos"]:
+                    raise KeyError("Some positions are not included in the BaseDSChrom.")
+
+            if np.all(np.diff(int_idx) == 1):
+                # contiguous positions, slicing is much cheaper than fancy indexing
+                obj = self.isel(pos=slice(int(int_idx[0]), int(int_idx[-1]) + 1))
+            else:
+                obj = self.isel(pos=int_idx)
 
         # copy attrs to avoid changing the original attrs of self
         obj.attrs = obj.attrs.copy()
@@ -235,15 +324,38 @@ class BaseDSChrom(xr.Dataset):
         """
         if self.continuous and len(positions) != 0:
             # if obj is continuous, pre-fetch the min max pos to speed up
-            pos_min = min(positions)
-            pos_max = max(positions) + 1
+            pos_arr = np.asarray(positions)
+            pos_min = int(pos_arr.min())
+            pos_max = int(pos_arr.max()) + 1
             obj = self.fetch(pos_min, pos_max)
+            if pos_max - pos_min == pos_arr.size and np.all(np.diff(pos_arr) == 1):
+                # contiguous positions, the pre-fetched region is already the selection
+                # attrs are copied in fetch
+                if obj.sizes["pos"] != pos_max - pos_min:
+                    raise KeyError("Some positions are not included in the BaseDSChrom.")
+                obj.continuous = False
+                obj.coords["pos"] = np.arange(pos_min, pos_max, dtype=np.uint32)
+                return obj
             return obj._fetch_positions(positions)
         else:
             return self._fetch_positions(positions)
 
     @staticmethod
-    def _xarray_open(path, obs_dim):
+    def _open_zarr(path, backend="zarr"):
+        if backend == "zarr":
+            ds = xr.open_zarr(path, decode_cf=False)
+        elif backend == "tensorstore":
+            try:
+                import xarray_tensorstore
+            except ImportError:
+                raise ImportError("Please install xarray-tensorstore to use the tensorstore backend.")
+            ds = xarray_tensorstore.open_zarr(str(path), mask_and_scale=False)
+        else:
+            raise ValueError(f"Unknown backend {backend}, must be zarr or tensorstore.")
+        return ds
+
+    @classmethod
+    def _xarray_open(cls, path, obs_dim, backend="zarr"):
         multi = False
         if isinstance(path, (str, pathlib.Path)):
             if "*" in str(path):
@@ -255,13 +367,16 @@ class BaseDSChrom(xr.Dataset):
                 path = path[0]
 
         if multi:
+            if backend != "zarr":
+                # concatenating lazy tensorstore arrays along obs_dim will load them into memory
+                raise ValueError(f"The {backend} backend only supports opening a single zarr path.")
             ds = xr.open_mfdataset(path, concat_dim=obs_dim, combine="nested", engine="zarr", decode_cf=False)
         else:
-            ds = xr.open_zarr(path, decode_cf=False)
+            ds = cls._open_zarr(path, backend=backend)
         return ds
 
     @classmethod
-    def open(cls, path, start=None, end=None, codebook_path=None, obs_dim="sample_id"):
+    def open(cls, path, start=None, end=None, codebook_path=None, obs_dim="sample_id", backend="zarr"):
         """
         Open a BaseDSChrom object from a zarr path.
 
@@ -280,27 +395,30 @@ class BaseDSChrom(xr.Dataset):
             Codebook contexts, c_pos, and shape must be compatible with the BaseDS.
         obs_dim
             The dimension name of the observation dimension.
+        backend
+            The backend to read zarr, "zarr" (default) or "tensorstore".
+            The tensorstore backend requires the xarray-tensorstore package,
+            it reads chunks concurrently and is faster for fetching many small regions or positions,
+            but only supports a single zarr path.
 
         Returns
         -------
         BaseDSChrom
         """
-        _zarr_obj = cls._xarray_open(path, obs_dim=obs_dim)
+        _zarr_obj = cls._xarray_open(path, obs_dim=obs_dim, backend=backend)
 
         if "codebook" not in _zarr_obj.data_vars:
             if codebook_path is None:
                 raise ValueError("The BaseDS does not have a codebook, but no codebook_path is specified.")
-            _cb = xr.open_zarr(codebook_path, decode_cf=False)["codebook"]
+            _cb = cls._open_zarr(codebook_path, backend=backend)["codebook"]
             # validate _cb attrs compatibility
             flag = True
             _cb_mc_types = _cb.get_index("mc_type").values
             _obj_mc_types = _zarr_obj.get_index("mc_type").values
-            # noinspection PyUnresolvedReferences
-            _diff = (_cb_mc_types != _obj_mc_types).sum()
-            if _diff > 0:
+            if not np.array_equal(_cb_mc_types, _obj_mc_types):
                 flag = False
                 print("The codebook mc_types are not compatible with the BaseDS.")
-            if _cb.shape[0] != _zarr_obj["data"].shape[0]:
+            if _cb.sizes["pos"] != _zarr_obj["data"].sizes["pos"]:
                 flag = False
                 print("The codebook shape is not compatible with the BaseDS.")
             if not flag:
@@ -359,10 +477,20 @@ class BaseDSChrom(xr.Dataset):
     @property
     def codebook(self) -> Codebook:
         """Get the codebook data array."""
-        # catch the codebook in the attrs, only effective in memory
+        # cache the codebook in memory, the cache is only valid for the same
+        # dataset object and the same codebook variable it was built from
+        key = id(self)
+        cb_var = self.variables["codebook"]
+        cache = _CODEBOOK_CACHE.get(key)
+        if cache is not None and cache[0]() is self and cache[1] is cb_var:
+            return cache[2]
+
         cb = Codebook(self["codebook"])
         cb.attrs["c_pos"] = self.attrs["c_pos"]
         cb.attrs["context_size"] = self.attrs["context_size"]
+        # the entry is removed when self is garbage collected
+        self_ref = weakref.ref(self, lambda _: _CODEBOOK_CACHE.pop(key, None))
+        _CODEBOOK_CACHE[key] = (self_ref, cb_var, cb)
         return cb
 
     @property
@@ -383,8 +511,13 @@ class BaseDSChrom(xr.Dataset):
         -------
         BaseDSChrom
         """
-        pattern_pos = self.codebook.get_mc_pos(pattern, offset=self.offset)
+        cb = self.codebook
+        pattern_bool = cb.get_mc_pos_bool(pattern)
+        if not self.continuous and pattern_bool.all():
+            # all positions match the pattern (e.g., mc_type already selected), no need to index
+            return self.copy(deep=False)
 
+        pattern_pos = cb._bool_to_pos(pattern_bool, offset=self.offset)
         ds = self.fetch_positions(positions=pattern_pos)
         assert ds.continuous is False
         return ds
@@ -394,6 +527,11 @@ class BaseDSChrom(xr.Dataset):
         """The position index."""
         return self.get_index("pos")
 
+    @property
+    def pos_values(self) -> np.ndarray:
+        """The position values as numpy array."""
+        return self.get_index("pos").values
+
     def get_region_ds(
         self,
         mc_type,
@@ -436,7 +574,7 @@ class BaseDSChrom(xr.Dataset):
 
         if bin_size is not None:
             assert bin_size > 1, "bin_size must be greater than 1."
-            all_idx = self.get_index("pos")
+            all_idx = self.pos_index
             region_start = all_idx.min() + self.offset if region_start is None else region_start
             region_end = all_idx.max() + self.offset if region_end is None else region_end
 
@@ -457,13 +595,13 @@ class BaseDSChrom(xr.Dataset):
         else:
             # use all positions in the BaseDS (mc_type selection may have been done)
             base_ds = self
-            pos_idx = base_ds.get_index("pos")
+            pos_idx = base_ds.pos_index
             if regions is not None:
                 region_pos_idx = _regions_to_pos(regions=np.array(regions))
                 pos_idx = pos_idx.intersection(region_pos_idx).astype(int)
                 base_ds = self.fetch_positions(positions=pos_idx)
                 # update pos_idx
-                pos_idx = base_ds.get_index("pos")
+                pos_idx = base_ds.pos_index
 
         # prepare regions
         if regions is not None:
@@ -471,42 +609,21 @@ class BaseDSChrom(xr.Dataset):
             labels = regions.index
             region_name = regions.index.name
         else:
-            bins = []
-            for i in range(0, self.chrom_size, bin_size):
-                if i < region_start or i > region_end:
-                    continue
-                bins.append(i)
-            if bins[-1] < region_end:
-                bins.append(region_end)
+            # bin_size aligned bin edges within [region_start, region_end]
+            start_aligned = (region_start // bin_size) * bin_size
+            bins = np.arange(start_aligned, region_end + bin_size, bin_size)
+            bins = bins[(bins >= region_start) & (bins <= region_end) & (bins < self.chrom_size)]
+            if bins.size == 0 or bins[-1] < region_end:
+                bins = np.append(bins, region_end)
             if bins[0] > region_start:
-                bins.insert(0, region_start)
+                bins = np.insert(bins, 0, region_start)
 
-            labels = []
-            for start in bins[:-1]:
-                labels.append(start)
+            labels = bins[:-1].copy()
 
-        if mc_type is not None and len(pos_idx) == 0:
-            # border case, no CpX selected by mc_type
-            # create an empty region_ds
-            region_ds = base_ds["data"].rename({"pos": "pos_bins"})
-            region_ds = region_ds.reindex({"pos_bins": labels}, fill_value=0)
-        else:
-            region_ds = (
-                base_ds["data"]
-                .groupby_bins(
-                    group="pos",
-                    bins=bins,
-                    # important, include the start position but exclude the end position;
-                    # the same as BED format
-                    right=False,
-                    labels=labels,
-                    precision=3,
-                    include_lowest=True,
-                    squeeze=True,
-                    restore_coord_dims=False,
-                )
-                .sum(dim="pos")
-            )
+        # positions of a continuous BaseDSChrom are relative to its offset
+        pos_values = base_ds.pos_values + base_ds.offset
+        # if no CpX selected by mc_type, all bins are empty and filled with 0
+        region_ds = _sum_by_bins(base_ds["data"], pos_values=pos_values, bins=bins, labels=labels)
         if region_chunks is not None:
             region_ds = region_ds.chunk({"pos_bins": region_chunks})
         if region_name is not None:
@@ -712,7 +829,7 @@ class BaseDSChrom(xr.Dataset):
 
 
 class BaseDS:
-    def __init__(self, paths, chrom_sizes_path, codebook_path=None):
+    def __init__(self, paths, chrom_sizes_path, codebook_path=None, backend="zarr"):
         """
         A wrapper for one or multiple BaseDS datasets.
 
@@ -724,11 +841,14 @@ class BaseDS:
             Path to the chromosome sizes file.
         codebook_path :
             Path to the codebook file.
+        backend :
+            The backend to read zarr, "zarr" (default) or "tensorstore", see BaseDSChrom.open.
         """
         self.paths = self._parse_paths(paths)
         self.codebook_path = codebook_path
         self.chrom_sizes_path = chrom_sizes_path
         self.chrom_sizes = pd.read_csv(chrom_sizes_path, sep="\t", header=None, index_col=0).squeeze()
+        self.backend = backend
         self.__base_ds_cache = {}
 
     @staticmethod
@@ -750,15 +870,54 @@ class BaseDS:
     def _get_chrom_paths(self, chrom):
         return [f"{p}/{chrom}" for p in self.paths]
 
+    def _open_chrom_ds(self, chrom):
+        return BaseDSChrom.open(
+            path=self._get_chrom_paths(chrom),
+            codebook_path=f"{self.codebook_path}/{chrom}",
+            backend=self.backend,
+        )
+
     def _get_chrom_ds(self, chrom):
         if chrom not in self.__base_ds_cache:
-            self.__base_ds_cache[chrom] = BaseDSChrom.open(
-                path=self._get_chrom_paths(chrom),
-                codebook_path=f"{self.codebook_path}/{chrom}",
-            )
+            self.__base_ds_cache[chrom] = self._open_chrom_ds(chrom)
         _chrom_ds: BaseDSChrom = self.__base_ds_cache[chrom]
         return _chrom_ds
 
+    def prefetch_chroms(self, chroms=None, max_workers=8):
+        """
+        Open multiple chromosome datasets concurrently and cache them.
+
+        Opening a chromosome only reads zarr metadata and coordinates, which is I/O bound,
+        so using threads hides the latency of serial opening, especially on remote stores.
+
+        Parameters
+        ----------
+        chroms :
+            Chromosome names to open. If None, open all chromosomes in the chrom sizes file.
+        max_workers :
+            Maximum number of threads.
+
+        Returns
+        -------
+        None
+        """
+        from concurrent.futures import ThreadPoolExecutor, as_completed
+
+        if chroms is None:
+            chroms = self.chrom_sizes.index
+        if isinstance(chroms, str):
+            chroms = [chroms]
+        chroms = [chrom for chrom in chroms if chrom not in self.__base_ds_cache]
+        if len(chroms) == 0:
+            return
+
+        with ThreadPoolExecutor(min(max_workers, len(chroms))) as exe:
+            futures = {exe.submit(self._open_chrom_ds, chrom): chrom for chrom in chroms}
+            for future in as_completed(futures):
+                chrom = futures[future]
+                self.__base_ds_cache[chrom] = future.result()
+        return
+
     def fetch(self, chrom, start=None, end=None):
         """
         Fetch a BaseDS for a genomic region.
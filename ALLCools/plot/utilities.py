@@ -5,31 +5,28 @@ import numpy as np
 import pandas as pd
 import seaborn as sns
 import xarray as xr
-from sklearn.neighbors import LocalOutlierFactor
+from scipy.spatial import cKDTree
 
 
 def _density_based_sample(data: pd.DataFrame, coords: list, portion=None, size=None, seed=None):
     """Down sample data based on density, to prevent overplot in dense region and decrease plotting time."""
-    clf = LocalOutlierFactor(
-        n_neighbors=20,
-        algorithm="auto",
-        leaf_size=30,
-        metric="minkowski",
-        p=2,
-        metric_params=None,
-        contamination=0.1,
-    )
-
     # coords should already exist in data, get them by column names list
     data_coords = data[coords]
-    clf.fit(data_coords)
-    # original score is negative, the larger the denser
-    density_score = clf.negative_outlier_factor_
+    coords_values = data_coords.values
+
+    # density proxy: mean distance to the 20 nearest neighbors, the first neighbor is the point itself
+    n_neighbors = min(20, coords_values.shape[0] - 1)
+    tree = cKDTree(coords_values)
+    dists, _ = tree.query(coords_values, k=n_neighbors + 1, workers=-1)
+    # score is negative, the larger the denser
+    density_score = -dists[:, 1:].mean(axis=1)
     delta = density_score.max() - density_score.min()
     # density score to probability: the denser the less probability to be picked up
     probability_score = 1 - (density_score - density_score.min()) / delta
     probability_score = np.sqrt(probability_score)
     probability_score = probability_score / probability_score.sum()
+    if not np.isfinite(probability_score).all():
+        raise ValueError("Can not compute density based probability, all points may have the same density.")
 
     if size is not None:
         pass
@@ -37,14 +34,16 @@ def _density_based_sample(data: pd.DataFrame, coords: list, portion=None, size=N
         size = int(data_coords.index.size * portion)
     else:
         raise ValueError("Either portion or size should be provided.")
-    if seed is not None:
-        np.random.seed(seed)
-    selected_cell_index = np.random.choice(
-        data_coords.index, size=size, replace=False, p=probability_score
-    )  # choice data based on density weights
-
-    # return the down sampled data
-    return data.reindex(selected_cell_index)
+    # choice data based on density weights, weighted sampling without replacement (Efraimidis-Spirakis):
+    # the size smallest keys -log(U) / p are selected, O(N) without the permutations of np.random.choice
+    rng = np.random.default_rng(seed)
+    with np.errstate(divide="ignore"):
+        keys = rng.standard_exponential(probability_score.size) / probability_score
+    selected = np.argpartition(keys, size - 1)[:size]
+
+    # return the down sampled data, selected are positional indices, no need to align labels;
+    # shuffle the selection so the plotting order does not follow the input order
+    return data.iloc[rng.permutation(selected)]
 
 
 def _translate_coord_name(coord_name):
@@ -0,0 +1,89 @@
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+
+from ALLCools.mcds.base_ds import BaseDSChrom, _sum_by_bins
+
+
+def _toy_data(n_pos, n_sample=3, seed=0):
+    rng = np.random.default_rng(seed)
+    values = rng.integers(0, 5, size=(n_pos, n_sample, 2), dtype=np.uint16)
+    return xr.DataArray(
+        values,
+        dims=("pos", "sample_id", "count_type"),
+        coords={"sample_id": [f"s{i}" for i in range(n_sample)], "count_type": ["mc", "cov"]},
+    )
+
+
+def _groupby_bins_sum(data, bins, labels):
+    region_da = data.groupby_bins("pos", bins=bins, right=False, labels=labels).sum(dim="pos")
+    # empty bins are missing or NaN in groupby_bins results
+    return region_da.reindex(pos_bins=labels).fillna(0)
+
+
+def _assert_same_sum(result, expected, region_dim="pos_bins"):
+    expected = expected.transpose(*result.dims)
+    np.testing.assert_array_equal(result.get_index(region_dim), expected.get_index(region_dim))
+    np.testing.assert_array_equal(result.values, expected.values)
+
+
+def test_sum_by_bins_matches_groupby_bins():
+    # no positions in [100, 130), positions before the first and after the last bin are ignored
+    pos = np.concatenate([np.arange(0, 100, 3), np.arange(130, 200, 2)])
+    data = _toy_data(pos.size).assign_coords(pos=pos)
+    bins = [5, 10, 40, 100, 120, 130, 180]
+    labels = bins[:-1]
+
+    result = _sum_by_bins(data, pos_values=pos, bins=bins, labels=labels)
+    _assert_same_sum(result, _groupby_bins_sum(data, bins, labels))
+    assert (result.sel(pos_bins=[100, 120]) == 0).all()
+
+
+def test_sum_by_bins_dask():
+    pytest.importorskip("dask")
+    pos = np.arange(0, 300, 2)
+    data = _toy_data(pos.size).assign_coords(pos=pos)
+    bins = [0, 50, 60, 200, 299]
+    labels = bins[:-1]
+
+    result = _sum_by_bins(data.chunk({"pos": 40}), pos_values=pos, bins=bins, labels=labels)
+    assert result.chunks is not None
+    # pos chunks are reduced separately, not merged into a single chunk
+    assert not any(name.startswith("rechunk-merge") for name in result.data.dask.layers)
+    _assert_same_sum(result.compute(), _groupby_bins_sum(data, bins, labels))
+
+
+def test_sum_by_bins_unsorted_bins():
+    pos = np.arange(100)
+    data = _toy_data(pos.size).assign_coords(pos=pos)
+    with pytest.raises(ValueError):
+        _sum_by_bins(data, pos_values=pos, bins=[0, 50, 20, 80], labels=[0, 50, 20])
+
+
+def test_get_region_ds_continuous_offset():
+    data = _toy_data(50)
+    ds = BaseDSChrom(xr.Dataset({"data": data}, attrs={"chrom": "chr1", "chrom_size": 1000, "obs_dim": "sample_id"}))
+    ds.continuous = True
+    ds.offset = 100
+
+    region_ds = ds.get_region_ds(mc_type=None, bin_size=20, region_chunks=None)
+
+    # region_start and region_end are the first and last position of the dataset
+    bins = [100, 120, 140, 149]
+    labels = bins[:-1]
+    expected = _groupby_bins_sum(data.assign_coords(pos=np.arange(50) + 100), bins, labels)
+    _assert_same_sum(region_ds["data"], expected)
+
+
+def test_get_region_ds_named_regions():
+    pos = np.arange(0, 100, 3)
+    data = _toy_data(pos.size).assign_coords(pos=pos)
+    ds = BaseDSChrom(xr.Dataset({"data": data}, attrs={"chrom": "chr1", "chrom_size": 1000, "obs_dim": "sample_id"}))
+    regions = pd.DataFrame({"start": [0, 20, 50], "end": [20, 50, 90]}, index=pd.Index(["r1", "r2", "r3"], name="dmr"))
+
+    region_ds = ds.get_region_ds(mc_type=None, regions=regions, region_chunks=None)
+
+    assert region_ds["data"].dims == ("dmr", "sample_id", "count_type")
+    expected = _groupby_bins_sum(data, [0, 20, 50, 90], ["r1", "r2", "r3"]).rename({"pos_bins": "dmr"})
+    _assert_same_sum(region_ds["data"], expected, region_dim="dmr")